@@ -6,31 +6,52 @@ Provides REST API for speaker verification and embedding extraction
 
 import os
 import io
+import re
 import time
 import uuid
+import threading
 import logging
 import traceback
 from pathlib import Path
 from typing import Dict, Any, Optional
 
-from flask import Flask, request, jsonify, send_from_directory, render_template_string
+# Pin BLAS/OpenMP pools before torch is imported (via modelscope) so that
+# concurrent inferences don't oversubscribe the CPU. Concurrent inferences =
+# worker processes (WORKERS) x request threads per worker (THREADS).
+CONCURRENT_INFERENCES = int(os.getenv('WORKERS', 1)) * int(os.getenv('THREADS', 1))
+THREADS_PER_INFER = int(os.getenv(
+    'THREADS_PER_INFER',
+    max(1, (os.cpu_count() or 1) // max(1, CONCURRENT_INFERENCES))
+))
+os.environ.setdefault('OMP_NUM_THREADS', str(THREADS_PER_INFER))
+os.environ.setdefault('MKL_NUM_THREADS', str(THREADS_PER_INFER))
+
+import torch
+from flask import Flask, request, jsonify, render_template_string
 from werkzeug.utils import secure_filename
 import soundfile as sf
 import numpy as np
 from modelscope.pipelines import pipeline
 from modelscope.utils.constant import Tasks
 
+torch.set_num_threads(THREADS_PER_INFER)
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    # Inter-op pool can only be sized once, before any parallel work starts
+    pass
+
 # Configure logging with file and console output
 log_dir = Path(__file__).parent / 'logs'
 log_dir.mkdir(exist_ok=True)
 log_file = log_dir / f'speaker_api_{time.strftime("%Y%m%d")}.log'
 
-# Create formatters
+# Create formatters (UNIX timestamps from record.created, skips time.strftime)
 detailed_formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
+    '%(created).3f - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
 )
 simple_formatter = logging.Formatter(
-    '%(asctime)s - %(levelname)s - %(message)s'
+    '%(created).3f - %(levelname)s - %(message)s'
 )
 
 # File handler (detailed logs)
@@ -141,6 +162,9 @@ class Config:
     MAX_DURATION = int(os.getenv('MAX_AUDIO_DURATION', 30))  # seconds
     MIN_DURATION = float(os.getenv('MIN_AUDIO_DURATION', 0.5))  # seconds
 
+    # Maximum number of audio pairs per /verify_batch request
+    MAX_BATCH_PAIRS = int(os.getenv('MAX_BATCH_PAIRS', 16))
+
 app.config.from_object(Config)
 
 # Create directories
@@ -151,8 +175,25 @@ os.makedirs(Config.CACHE_DIR, exist_ok=True)
 speaker_pipeline = None
 start_time = time.time()  # Initialize start_time at module load
 
+# Only one thread may load the model; _MODEL_READY is set once it is ready,
+# _MODEL_LOAD_DONE whenever a load attempt finishes (success or failure)
+_MODEL_LOCK = threading.Lock()
+_MODEL_READY = threading.Event()
+_MODEL_LOAD_DONE = threading.Event()
+MODEL_WAIT_TIMEOUT = float(os.getenv('MODEL_WAIT_TIMEOUT', 30))  # seconds
+
 def init_model(retry_count=3):
     """Initialize the speaker verification model with retry logic"""
+    with _MODEL_LOCK:
+        if _MODEL_READY.is_set():
+            return True
+        _MODEL_LOAD_DONE.clear()
+        try:
+            return _load_model(retry_count)
+        finally:
+            _MODEL_LOAD_DONE.set()
+
+def _load_model(retry_count):
     global speaker_pipeline
 
     for attempt in range(retry_count):
@@ -177,6 +218,7 @@ def init_model(retry_count=3):
 
             if test_result:
                 logger.info("Model initialized and verified successfully")
+                _MODEL_READY.set()
                 return True
             else:
                 logger.warning(f"Model verification failed on attempt {attempt + 1}")
@@ -194,6 +236,28 @@ def init_model(retry_count=3):
 
     return False
 
+def start_model_loading():
+    """Load the model in the background unless it is ready or already loading"""
+    if _MODEL_READY.is_set() or _MODEL_LOCK.locked():
+        return
+    logger.warning("Model not loaded, attempting to initialize...")
+    _MODEL_LOAD_DONE.clear()
+    threading.Thread(target=init_model, kwargs={'retry_count': 1}, daemon=True).start()
+
+def wait_for_model(timeout: float = MODEL_WAIT_TIMEOUT) -> bool:
+    """Wait for the model to load; returns False on timeout or as soon as loading fails"""
+    if _MODEL_READY.is_set():
+        return True
+    start_model_loading()
+    _MODEL_LOAD_DONE.wait(timeout=timeout)
+    return _MODEL_READY.is_set()
+
+def model_unavailable_response():
+    """Return a 503 response if the model can't be loaded in time, else None"""
+    if wait_for_model():
+        return None
+    return jsonify({"error": "Model not loaded. Server is initializing, please try again in a few seconds."}), 503
+
 def validate_audio_file(file_path: str) -> Dict[str, Any]:
     """Validate uploaded audio file"""
     try:
@@ -249,7 +313,7 @@ def after_request(response):
                 error_msg = f'HTTP {response.status_code}'
 
         # Only log /verify and /extract endpoints (avoid logging /health checks)
-        if endpoint in ['/verify', '/extract']:
+        if endpoint in ['/verify', '/verify_batch', '/extract']:
             monitor.log_request(endpoint, success, duration, error_msg, client_ip)
 
     return response
@@ -279,16 +343,13 @@ def docs():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Detailed health check"""
-    global speaker_pipeline
-
     # Try to reinitialize model if not loaded
-    if speaker_pipeline is None:
-        logger.warning("Model not loaded, attempting to initialize...")
-        init_model(retry_count=1)
+    start_model_loading()
+    model_loaded = _MODEL_READY.is_set()
 
     status = {
-        "status": "healthy" if speaker_pipeline is not None else "unhealthy",
-        "model_loaded": speaker_pipeline is not None,
+        "status": "healthy" if model_loaded else "unhealthy",
+        "model_loaded": model_loaded,
         "model_id": Config.MODEL_ID,
         "device": Config.DEVICE,
         "timestamp": time.time(),
@@ -296,7 +357,7 @@ def health_check():
         "statistics": monitor.get_stats()
     }
 
-    return jsonify(status), 200 if speaker_pipeline else 503
+    return jsonify(status), 200 if model_loaded else 503
 
 @app.route('/verify', methods=['POST'])
 def verify_speakers():
@@ -306,10 +367,9 @@ def verify_speakers():
     """
     try:
         # Check if model is loaded, try to initialize if not
-        if speaker_pipeline is None:
-            logger.warning("Model not loaded, attempting to initialize...")
-            if not init_model(retry_count=2):
-                return jsonify({"error": "Model not loaded. Server is initializing, please try again in a few seconds."}), 503
+        unavailable = model_unavailable_response()
+        if unavailable:
+            return unavailable
 
         # Check if files are provided
         if 'audio1' not in request.files or 'audio2' not in request.files:
@@ -376,7 +436,8 @@ def verify_speakers():
                 }
             }
 
-            logger.info(f"Verification completed - Session: {session_id}, Score: {similarity_score:.4f}, Time: {inference_time:.3f}s")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Verification completed - Session: {session_id}, Score: {similarity_score:.4f}, Time: {inference_time:.3f}s")
 
             return jsonify(response)
 
@@ -393,62 +454,127 @@ def verify_speakers():
         logger.error(traceback.format_exc())
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
-@app.route('/extract', methods=['POST'])
-def extract_embedding():
+@app.route('/verify_batch', methods=['POST'])
+def verify_batch():
     """
-    Extract speaker embedding from audio file
+    Batch speaker verification endpoint
+    Accepts N pairs of audio files as audio1_<i>/audio2_<i> (i = 0..N-1)
+    and returns one similarity score per pair in a single request
     """
     try:
-        if speaker_pipeline is None:
-            return jsonify({"error": "Model not loaded"}), 503
-
-        if 'audio' not in request.files:
-            return jsonify({"error": "Audio file is required"}), 400
-
-        audio_file = request.files['audio']
-
-        if audio_file.filename == '':
+        # Check if model is loaded, try to initialize if not
+        unavailable = model_unavailable_response()
+        if unavailable:
+            return unavailable
+
+        # Collect pairs audio1_0/audio2_0, audio1_1/audio2_1, ...
+        indices = {1: set(), 2: set()}
+        for key in request.files:
+            match = re.fullmatch(r'audio([12])_(\d+)', key)
+            if match:
+                # Only canonical indices (no leading zeros), so the field name
+                # can be rebuilt from the parsed index below
+                if match.group(2) != str(int(match.group(2))):
+                    return jsonify({"error": f"Invalid pair index in field '{key}'"}), 400
+                indices[int(match.group(1))].add(int(match.group(2)))
+
+        if not indices[1] and not indices[2]:
+            return jsonify({"error": "At least one 'audio1_0'/'audio2_0' pair is required"}), 400
+
+        if indices[1] != indices[2]:
+            unmatched = sorted(indices[1] ^ indices[2])
+            return jsonify({"error": f"Unmatched audio1_*/audio2_* fields for pairs: {unmatched}"}), 400
+
+        if indices[1] != set(range(len(indices[1]))):
+            return jsonify({"error": "Pair indices must be contiguous starting from 0"}), 400
+
+        pairs = [
+            (request.files[f'audio1_{i}'], request.files[f'audio2_{i}'])
+            for i in range(len(indices[1]))
+        ]
+
+        if len(pairs) > Config.MAX_BATCH_PAIRS:
+            return jsonify({"error": f"Too many pairs: {len(pairs)} (max: {Config.MAX_BATCH_PAIRS})"}), 400
+
+        if any(f1.filename == '' or f2.filename == '' for f1, f2 in pairs):
             return jsonify({"error": "No file selected"}), 400
 
-        # Save uploaded file
+        # Get threshold from request or use default
+        threshold = request.form.get('threshold', Config.SIMILARITY_THRESHOLD, type=float)
+
+        # Generate unique session ID
         session_id = str(uuid.uuid4())
-        filename = f"{session_id}_{secure_filename(audio_file.filename)}"
-        filepath = os.path.join(Config.UPLOAD_FOLDER, filename)
-        audio_file.save(filepath)
+        filepaths = []
 
         try:
-            # Validate audio file
-            validation = validate_audio_file(filepath)
-            if not validation["valid"]:
-                return jsonify({"error": validation["error"]}), 400
+            # Save and validate uploaded files
+            saved_pairs = []
+            for i, (audio1_file, audio2_file) in enumerate(pairs):
+                saved = []
+                for j, audio_file in enumerate((audio1_file, audio2_file), start=1):
+                    filepath = os.path.join(
+                        Config.UPLOAD_FOLDER,
+                        f"{session_id}_{i}_{j}_{secure_filename(audio_file.filename)}"
+                    )
+                    audio_file.save(filepath)
+                    filepaths.append(filepath)
+
+                    validation = validate_audio_file(filepath)
+                    if not validation["valid"]:
+                        return jsonify({"error": f"Pair {i} audio{j}: {validation['error']}"}), 400
+                    saved.append(filepath)
+                saved_pairs.append(saved)
 
-            # Extract embedding (this is a simplified version)
-            # Note: ModelScope pipeline doesn't directly expose embedding extraction
-            # You would need to use the actual model for this
+            # Perform speaker verification
+            results = []
+            inference_start = time.time()
+            for i, (filepath1, filepath2) in enumerate(saved_pairs):
+                similarity_score = float(speaker_pipeline([filepath1, filepath2])['score'])
+                is_same_speaker = similarity_score >= threshold
+                results.append({
+                    "pair": i,
+                    "audio1": pairs[i][0].filename,
+                    "audio2": pairs[i][1].filename,
+                    "similarity_score": similarity_score,
+                    "is_same_speaker": is_same_speaker,
+                    "confidence": similarity_score if is_same_speaker else (1 - similarity_score)
+                })
+            inference_time = time.time() - inference_start
 
-            response = {
-                "session_id": session_id,
-                "filename": audio_file.filename,
-                "audio_info": {
-                    "duration": round(validation["duration"], 2),
-                    "sample_rate": validation["sample_rate"]
-                },
-                "message": "Embedding extraction not implemented in this version. Use the infer_sv_lite.py script for embedding extraction."
-            }
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Batch verification completed - Session: {session_id}, Pairs: {len(results)}, Time: {inference_time:.3f}s")
 
-            return jsonify(response)
+            return jsonify({
+                "session_id": session_id,
+                "threshold": threshold,
+                "inference_time": round(inference_time, 3),
+                "results": results
+            })
 
         finally:
-            # Clean up uploaded file
-            try:
-                os.remove(filepath)
-            except Exception as e:
-                logger.warning(f"Failed to cleanup file: {e}")
+            # Clean up uploaded files
+            for filepath in filepaths:
+                try:
+                    os.remove(filepath)
+                except Exception as e:
+                    logger.warning(f"Failed to cleanup file: {e}")
 
     except Exception as e:
-        logger.error(f"Embedding extraction error: {e}")
+        logger.error(f"Batch verification error: {e}")
+        logger.error(traceback.format_exc())
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+@app.route('/extract', methods=['POST'])
+def extract_embedding():
+    """
+    Extract speaker embedding from audio file
+
+    Not implemented: the ModelScope pipeline doesn't directly expose embedding
+    extraction, so reject early instead of saving and validating the upload.
+    Use the infer_sv_lite.py script for embedding extraction.
+    """
+    return jsonify({"error": "not implemented"}), 501
+
 @app.route('/models', methods=['GET'])
 def list_models():
     """List available models"""
@@ -635,6 +761,27 @@ API_DOCS_HTML = '''
 }</div>
         </div>
 
+        <div class="endpoint">
+            <h3><span class="method post">POST</span> /verify_batch</h3>
+            <p><strong>Description:</strong> Verify several audio pairs in one request</p>
+            <p><strong>Parameters:</strong></p>
+            <table>
+                <tr><th>Parameter</th><th>Type</th><th>Required</th><th>Description</th></tr>
+                <tr><td>audio1_&lt;i&gt;</td><td>File</td><td>Yes</td><td>First audio file of pair i (i = 0, 1, ...)</td></tr>
+                <tr><td>audio2_&lt;i&gt;</td><td>File</td><td>Yes</td><td>Second audio file of pair i</td></tr>
+                <tr><td>threshold</td><td>Float</td><td>No</td><td>Similarity threshold (default: 0.5)</td></tr>
+            </table>
+            <p><strong>Response:</strong></p>
+            <div class="code">{
+  "session_id": "uuid-string",
+  "threshold": 0.5,
+  "inference_time": 0.312,
+  "results": [
+    {"pair": 0, "similarity_score": 0.8234, "is_same_speaker": true, "confidence": 0.8234}
+  ]
+}</div>
+        </div>
+
         <div class="endpoint">
             <h3><span class="method get">GET</span> /models</h3>
             <p><strong>Description:</strong> List available speaker verification models</p>
@@ -670,6 +817,7 @@ API_DOCS_HTML = '''
             <tr><td>DEVICE</td><td>cpu</td><td>cpu or cuda</td></tr>
             <tr><td>SIMILARITY_THRESHOLD</td><td>0.5</td><td>Default threshold</td></tr>
             <tr><td>MAX_AUDIO_DURATION</td><td>30</td><td>Max audio length (seconds)</td></tr>
+            <tr><td>MAX_BATCH_PAIRS</td><td>16</td><td>Max pairs per /verify_batch request</td></tr>
         </table>
 
         <h2>📝 Example Usage</h2>
@@ -5,9 +5,10 @@ Export PyTorch speaker models to ONNX format for efficient inference
 
 import os
 import argparse
+import numpy as np
 import torch
 import yaml
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
 from modelscope.hub.snapshot_download import snapshot_download
 
 
@@ -52,6 +53,17 @@ def load_model_from_modelscope(model_id: str, cache_dir: str = "./models") -> Tu
     return model, config
 
 
+class NormalizedEmbedding(torch.nn.Module):
+    """Wrap a speaker model so the exported graph L2-normalizes its embedding"""
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return torch.nn.functional.normalize(self.model(x), dim=-1)
+
+
 def export_to_onnx(
     model: torch.nn.Module,
     output_path: str,
@@ -71,16 +83,20 @@ def export_to_onnx(
     """
     print(f"Exporting model to ONNX: {output_path}")
 
-    # Create dummy input
-    dummy_input = torch.randn(batch_size, 1, sequence_length)
+    # Create dummy input, reused for the ORT validation run below
+    dummy_input = torch.empty(
+        batch_size, 1, sequence_length, pin_memory=torch.cuda.is_available()
+    )
+    dummy_input.normal_()
 
-    # Export to ONNX
+    # Export to ONNX, with the final L2-normalization inside the graph
     torch.onnx.export(
-        model,
+        NormalizedEmbedding(model),
         dummy_input,
         output_path,
         export_params=True,
-        opset_version=14,
+        opset_version=17,  # LayerNormalization exported as a single op
+        operator_export_type=torch.onnx.OperatorExportTypes.ONNX,
         do_constant_folding=True,
         input_names=['audio'],
         output_names=['embedding'],
@@ -103,8 +119,19 @@ def export_to_onnx(
         onnx.checker.check_model(onnx_model)
         print("ONNX model validation passed")
 
-        # Test inference
-        ort_session = ort.InferenceSession(output_path)
+        num_layer_norm = sum(
+            node.op_type == 'LayerNormalization' for node in onnx_model.graph.node
+        )
+        print(f"Fused LayerNormalization nodes: {num_layer_norm}")
+
+        # Test inference with the same session settings as production
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = max(1, (os.cpu_count() or 1) // 2)
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.enable_cpu_mem_arena = True
+        ort_session = ort.InferenceSession(
+            output_path, sess_options, providers=['CPUExecutionProvider']
+        )
         ort_inputs = {ort_session.get_inputs()[0].name: dummy_input.numpy()}
         ort_outputs = ort_session.run(None, ort_inputs)
         print(f"Test inference successful, output shape: {ort_outputs[0].shape}")
@@ -115,63 +142,201 @@ def export_to_onnx(
         print(f"Validation failed: {e}")
 
 
-def optimize_onnx(input_path: str, output_path: str):
+def _max_abs_diff(reference_path: str, candidate_path: str, sequence_length: int = 16000 * 3) -> float:
+    """
+    Run one forward through two ONNX models and compare their outputs
+
+    Args:
+        reference_path: Reference ONNX file path
+        candidate_path: ONNX file path to compare against the reference
+        sequence_length: Audio sequence length (samples)
+
+    Returns:
+        Maximum absolute difference between the two outputs
+    """
+    import onnxruntime as ort
+
+    dummy_input = np.random.randn(1, 1, sequence_length).astype(np.float32)
+    outputs = []
+    for path in (reference_path, candidate_path):
+        session = ort.InferenceSession(path, providers=['CPUExecutionProvider'])
+        outputs.append(session.run(None, {session.get_inputs()[0].name: dummy_input})[0])
+
+    return float(np.max(np.abs(outputs[0] - outputs[1])))
+
+
+def optimize_onnx(input_path: str, output_path: str, opt_level: int = 99) -> bool:
     """
     Optimize ONNX model for inference
 
+    Runs ONNXRuntime's graph optimization (constant folding, Conv+BN fusion).
+    At the full level it also applies layout/FusedConv rewrites and the
+    LayerNorm/SkipLayerNorm/Gelu fusions, which are the ones that apply to
+    audio models. Those produce hardware-specific contrib ops, so graphs meant
+    for quantization should use opt_level=1.
+
     Args:
         input_path: Input ONNX file path
         output_path: Optimized ONNX file path
+        opt_level: ONNXRuntime graph optimization level (1, 2 or 99)
+
+    Returns:
+        True if the optimized model was written, False otherwise
     """
     try:
+        import onnx
         from onnxruntime.transformers import optimizer
+        from onnxruntime.transformers.onnx_model import OnnxModel
+        from onnxruntime.transformers.fusion_layernorm import FusionLayerNormalization
+        from onnxruntime.transformers.fusion_skiplayernorm import FusionSkipLayerNormalization
+        from onnxruntime.transformers.fusion_gelu import FusionGelu
 
         print(f"Optimizing ONNX model: {input_path}")
 
         # Optimize model
-        optimized_model = optimizer.optimize_model(
+        optimizer.optimize_by_onnxruntime(
             input_path,
-            model_type='bert',  # Use bert optimizer for transformer-based models
-            num_heads=8,
-            hidden_size=256,
-            optimization_options=optimizer.OptimizationOptions(
-                enable_gelu_approximation=True,
-                enable_embed_layer_norm_fusion=True
-            )
+            use_gpu=False,
+            optimized_model_path=output_path,
+            opt_level=opt_level,
+            disabled_optimizers=[]
         )
 
+        onnx_model = OnnxModel(onnx.load(output_path))
+        if opt_level > 1:
+            for fusion in (FusionLayerNormalization, FusionSkipLayerNormalization, FusionGelu):
+                fusion(onnx_model).apply()
+        onnx_model.prune_graph()
+
         # Save optimized model
-        optimized_model.save_model_to_file(output_path)
+        onnx_model.save_model_to_file(output_path)
         print(f"Optimized model saved to: {output_path}")
 
+        # Fusions can silently change numerics; check against the original graph
+        max_diff = _max_abs_diff(input_path, output_path)
+        if max_diff >= 1e-3:
+            print(f"Warning: optimized model output differs by {max_diff:.2e} (max|diff| >= 1e-3)")
+        else:
+            print(f"Optimized model output matches original (max|diff| = {max_diff:.2e})")
+        return True
+
     except ImportError:
         print("ONNXRuntime transformers not installed, skipping optimization")
-        print("Install with: pip install onnxruntime-tools")
+        print("Install with: pip install onnxruntime")
     except Exception as e:
         print(f"Optimization failed: {e}")
+    return False
 
 
-def quantize_onnx(input_path: str, output_path: str):
+def _wav_calibration_reader(
+    input_name: str,
+    calibration_dir: str,
+    num_samples: int,
+    sequence_length: int,
+    sample_rate: int = 16000
+):
+    """
+    Build a calibration data reader feeding real audio to the quantizer
+
+    Args:
+        input_name: Name of the model input
+        calibration_dir: Directory of calibration wav files
+        num_samples: Maximum number of calibration samples
+        sequence_length: Audio sequence length (samples)
+        sample_rate: Sample rate the model expects
+    """
+    import torchaudio
+    from onnxruntime.quantization import CalibrationDataReader
+
+    wav_paths = sorted(
+        os.path.join(calibration_dir, name)
+        for name in os.listdir(calibration_dir) if name.endswith('.wav')
+    )[:num_samples]
+    if not wav_paths:
+        raise ValueError(f"No .wav files found in calibration directory: {calibration_dir}")
+
+    class WavCalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            self.paths = iter(wav_paths)
+
+        def get_next(self):
+            wav_path = next(self.paths, None)
+            if wav_path is None:
+                return None
+            wav, fs = torchaudio.load(wav_path)
+            if fs != sample_rate:
+                wav = torchaudio.functional.resample(wav, fs, sample_rate)
+            # First channel, cropped / zero padded to the export length
+            wav = wav[0, :sequence_length]
+            wav = torch.nn.functional.pad(wav, (0, sequence_length - wav.shape[0]))
+            return {input_name: wav.reshape(1, 1, -1).numpy().astype(np.float32)}
+
+    return WavCalibrationReader()
+
+
+def quantize_onnx(
+    input_path: str,
+    output_path: str,
+    calibration_dir: str = None,
+    num_calibration_samples: int = 100,
+    sequence_length: int = 16000 * 3
+):
     """
     Quantize ONNX model to INT8 for faster inference
 
+    Uses dynamic quantization unless a calibration directory is given, in
+    which case weights and activations are statically quantized (QDQ format).
+
     Args:
         input_path: Input ONNX file path
         output_path: Quantized ONNX file path
+        calibration_dir: Directory of wav files for static quantization
+        num_calibration_samples: Number of calibration samples for static quantization
+        sequence_length: Audio sequence length of calibration samples
     """
+    preprocessed_path = input_path + '.preproc'
     try:
-        from onnxruntime.quantization import quantize_dynamic, QuantType
+        from onnxruntime.quantization import (
+            quantize_dynamic, quantize_static, QuantFormat, QuantType
+        )
+
+        from onnxruntime.quantization.shape_inference import quant_pre_process
 
         print(f"Quantizing ONNX model: {input_path}")
 
-        quantize_dynamic(
-            model_input=input_path,
-            model_output=output_path,
-            weight_type=QuantType.QInt8,
-            optimize_model=True,
-            per_channel=True,
-            reduce_range=True
-        )
+        # Symbolic shape inference + constant folding, so the quantizer can
+        # recognize the MatMul/Conv tensors
+        quant_pre_process(input_path, preprocessed_path, skip_symbolic_shape=False)
+
+        if calibration_dir is None:
+            quantize_dynamic(
+                model_input=preprocessed_path,
+                model_output=output_path,
+                weight_type=QuantType.QInt8,
+                optimize_model=True,
+                per_channel=True,
+                reduce_range=True
+            )
+        else:
+            import onnx
+            input_name = onnx.load(preprocessed_path).graph.input[0].name
+            reader = _wav_calibration_reader(
+                input_name, calibration_dir, num_calibration_samples, sequence_length
+            )
+
+            # Static symmetric per-channel INT8; QDQ keeps S8S8 on the fast
+            # x86 kernels, unlike QOperator
+            quantize_static(
+                preprocessed_path,
+                output_path,
+                reader,
+                quant_format=QuantFormat.QDQ,
+                per_channel=True,
+                reduce_range=False,
+                weight_type=QuantType.QInt8,
+                activation_type=QuantType.QInt8,
+                op_types_to_quantize=['MatMul', 'Conv', 'Gemm']
+            )
 
         print(f"Quantized model saved to: {output_path}")
 
@@ -181,12 +346,17 @@ def quantize_onnx(input_path: str, output_path: str):
         reduction = (1 - quantized_size / original_size) * 100
 
         print(f"Model size reduced from {original_size:.2f}MB to {quantized_size:.2f}MB ({reduction:.1f}% reduction)")
+        if quantized_size > 0.8 * original_size:
+            print("Warning: quantized model is larger than 80% of the original, most ops were likely not quantized")
 
     except ImportError:
         print("ONNXRuntime quantization not installed")
-        print("Install with: pip install onnxruntime-tools")
+        print("Install with: pip install onnxruntime")
     except Exception as e:
         print(f"Quantization failed: {e}")
+    finally:
+        if os.path.exists(preprocessed_path):
+            os.remove(preprocessed_path)
 
 
 def main():
@@ -200,6 +370,8 @@ def main():
                        help='Optimize ONNX model')
     parser.add_argument('--quantize', action='store_true',
                        help='Quantize model to INT8')
+    parser.add_argument('--calibration_dir', type=str, default=None,
+                       help='Directory of wav files for static INT8 quantization (dynamic if omitted)')
     parser.add_argument('--batch_size', type=int, default=1,
                        help='Batch size for export')
     parser.add_argument('--sequence_length', type=int, default=48000,
@@ -232,20 +404,35 @@ def main():
         args.sequence_length
     )
 
-    # Optimize if requested
+    export_path = args.output
+
+    # Optimize if requested (full level, for the FP32 inference artifact)
     if args.optimize:
-        optimized_path = args.output.replace('.onnx', '_optimized.onnx')
-        optimize_onnx(args.output, optimized_path)
-        args.output = optimized_path
+        optimized_path = export_path.replace('.onnx', '_optimized.onnx')
+        optimize_onnx(export_path, optimized_path)
 
-    # Quantize if requested
+    # Quantize if requested. The full optimization level emits FusedConv/NCHWc
+    # ops the quantizer skips, so quantize a basic-level graph instead
     if args.quantize:
-        quantized_path = args.output.replace('.onnx', '_quantized.onnx')
-        quantize_onnx(args.output, quantized_path)
+        quantize_input = export_path
+        basic_path = export_path.replace('.onnx', '_basic.onnx')
+        try:
+            if optimize_onnx(export_path, basic_path, opt_level=1):
+                quantize_input = basic_path
+
+            quantized_path = export_path.replace('.onnx', '_quantized.onnx')
+            quantize_onnx(
+                quantize_input,
+                quantized_path,
+                calibration_dir=args.calibration_dir,
+                sequence_length=args.sequence_length
+            )
+        finally:
+            if os.path.exists(basic_path):
+                os.remove(basic_path)
 
     print("\nExport completed successfully!")
 
 
 if __name__ == '__main__':
-    from typing import Tuple
     main()
\ No newline at end of file
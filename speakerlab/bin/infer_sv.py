@@ -39,6 +39,9 @@ parser.add_argument('--model_id', default='', type=str, help='Model id in models
 parser.add_argument('--wavs', nargs='+', type=str, help='Wavs')
 parser.add_argument('--local_model_dir', default='pretrained', type=str, help='Local model dir')
 
+# Inference device; detected in main() when left as None.
+device = None
+
 CAMPPLUS_VOX = {
     'obj': 'speakerlab.models.campplus.DTDNN.CAMPPlus',
     'args': {
@@ -246,7 +249,10 @@ def main():
     pretrained_model = save_dir / conf['model_pt']
     pretrained_state = torch.load(pretrained_model, map_location='cpu')
 
-    if torch.cuda.is_available():
+    global device
+    if device is not None:
+        print(f'[INFO]: Using {device} for inference.')
+    elif torch.cuda.is_available():
         msg = 'Using CUDA GPU for inference.'
         print(f'[INFO]: {msg}')
         device = torch.device('cuda')
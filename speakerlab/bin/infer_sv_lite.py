@@ -10,11 +10,78 @@ import numpy as np
 import torch
 import torchaudio
 import soundfile as sf
-from typing import Tuple, Optional
+from torch.utils.data import Dataset, DataLoader
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Optional, Union
 from modelscope.hub.file_download import model_file_download
 from modelscope.hub.snapshot_download import snapshot_download
 
 
+def read_audio(audio_path: str, max_seconds: Optional[float] = None) -> Tuple[torch.Tensor, int]:
+    """
+    Read an audio file as a mono waveform on CPU
+
+    Args:
+        audio_path: Path to audio file
+        max_seconds: Only decode the first max_seconds of audio
+
+    Returns:
+        Tuple of (waveform of shape (1, T), sample_rate)
+    """
+    # soundfile decodes straight into a numpy buffer that torch wraps without
+    # copying. Fall back to torchaudio for formats libsndfile can't read.
+    try:
+        with sf.SoundFile(audio_path) as f:
+            sample_rate = f.samplerate
+            frames = f.frames
+            if max_seconds is not None:
+                frames = min(frames, int(max_seconds * sample_rate))
+            data = f.read(frames=frames, dtype='float32', always_2d=False)
+        if data.ndim > 1:
+            # Convert to mono if needed
+            data = data.mean(axis=1, dtype=np.float32)
+        waveform = torch.from_numpy(data).unsqueeze(0)
+    except RuntimeError:
+        waveform, sample_rate = torchaudio.load(audio_path)
+
+        # Convert to mono if needed
+        if waveform.shape[0] > 1:
+            waveform = torch.mean(waveform, dim=0, keepdim=True)
+        if max_seconds is not None:
+            waveform = waveform[:, :int(max_seconds * sample_rate)]
+
+    return waveform, sample_rate
+
+
+class _WavDataset(Dataset):
+    """Decodes and resamples audio files on CPU for DataLoader workers"""
+
+    def __init__(self, audio_paths: List[str], target_sr: int):
+        self.audio_paths = audio_paths
+        self.target_sr = target_sr
+        self._resamplers: Dict[int, torchaudio.transforms.Resample] = {}
+
+    def __len__(self):
+        return len(self.audio_paths)
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        waveform, sample_rate = read_audio(self.audio_paths[index])
+        if sample_rate != self.target_sr:
+            if sample_rate not in self._resamplers:
+                self._resamplers[sample_rate] = torchaudio.transforms.Resample(sample_rate, self.target_sr)
+            waveform = self._resamplers[sample_rate](waveform)
+        return waveform
+
+
+def _pad_collate(wavs: List[torch.Tensor]) -> torch.Tensor:
+    """Right-pad (1, T) waveforms to the longest one and concatenate into (B, T)"""
+    max_len = max(wav.shape[-1] for wav in wavs)
+    return torch.cat([
+        torch.nn.functional.pad(wav, (0, max_len - wav.shape[-1])) for wav in wavs
+    ])
+
+
 class LiteSpeakerVerification:
     """Lightweight speaker verification using pre-trained models"""
 
@@ -30,6 +97,25 @@ class LiteSpeakerVerification:
         self.model_id = model_id
         self.cache_dir = cache_dir
         self.device = device
+        # Half precision on accelerators (BF16 on CUDA where supported, FP16
+        # otherwise), FP32 on CPU or when autocast isn't available
+        self._autocast_device, self._autocast_dtype = 'cpu', torch.bfloat16
+        if 'cuda' in str(device):
+            self._autocast_device = 'cuda'
+            if not torch.cuda.is_bf16_supported():
+                self._autocast_dtype = torch.float16
+        elif 'mps' in str(device):
+            try:
+                # MPS autocast needs torch >= 2.5
+                torch.autocast('mps', dtype=torch.float16)
+                self._autocast_device, self._autocast_dtype = 'mps', torch.float16
+            except RuntimeError:
+                print("MPS autocast not supported by this torch version, using FP32")
+        # Resample transforms keyed by (orig_sr, target_sr)
+        self._resamplers: Dict[Tuple[int, int], torchaudio.transforms.Resample] = {}
+        # Embeddings keyed by (path, mtime), oldest evicted first
+        self._emb_cache: "OrderedDict[Tuple[str, float], np.ndarray]" = OrderedDict()
+        self._emb_cache_size = 128
 
         # Create cache directory
         os.makedirs(cache_dir, exist_ok=True)
@@ -67,6 +153,10 @@ class LiteSpeakerVerification:
         if os.path.exists(model_path):
             self.model = torch.jit.load(model_path, map_location=self.device)
             self.model.eval()
+            # Inline attributes and fold Conv+BN / drop dropout in the JIT graph
+            preserved = ['extract_embedding'] if hasattr(self.model, 'extract_embedding') else None
+            self.model = torch.jit.freeze(self.model, preserved_attrs=preserved)
+            self.model = torch.jit.optimize_for_inference(self.model, other_methods=preserved)
         else:
             # Try loading from checkpoint
             ckpt_path = os.path.join(model_dir, 'model.ckpt')
@@ -83,28 +173,29 @@ class LiteSpeakerVerification:
 
         print(f"Model loaded successfully on {self.device}")
 
-    def load_audio(self, audio_path: str) -> torch.Tensor:
+    def load_audio(self, audio_path: str, max_seconds: Optional[float] = None) -> torch.Tensor:
         """
         Load and preprocess audio file
 
         Args:
             audio_path: Path to audio file
+            max_seconds: Only decode the first max_seconds of audio
 
         Returns:
             Preprocessed audio tensor
         """
         # Load audio
-        waveform, sample_rate = torchaudio.load(audio_path)
-
-        # Convert to mono if needed
-        if waveform.shape[0] > 1:
-            waveform = torch.mean(waveform, dim=0, keepdim=True)
+        waveform, sample_rate = read_audio(audio_path, max_seconds)
 
         # Resample if needed
         target_sr = self.config.get('sample_rate', 16000)
         if sample_rate != target_sr:
-            resampler = torchaudio.transforms.Resample(sample_rate, target_sr)
-            waveform = resampler(waveform)
+            key = (sample_rate, target_sr)
+            resampler = self._resamplers.get(key)
+            if resampler is None:
+                resampler = torchaudio.transforms.Resample(sample_rate, target_sr).to(self.device)
+                self._resamplers[key] = resampler
+            waveform = resampler(waveform.to(self.device))
 
         return waveform
 
@@ -118,41 +209,164 @@ class LiteSpeakerVerification:
         Returns:
             Speaker embedding vector
         """
+        key = self._cache_key(audio_path)
+        if key in self._emb_cache:
+            return self._emb_cache[key]
+
         # Load and preprocess audio
         waveform = self.load_audio(audio_path)
+
+        embedding = self._to_numpy(self._forward(waveform))
+        self._cache_put(key, embedding)
+        return embedding
+
+    @staticmethod
+    def _cache_key(audio_path: str) -> Tuple[str, float]:
+        return audio_path, os.path.getmtime(audio_path)
+
+    def _cache_put(self, key: Tuple[str, float], embedding: np.ndarray):
+        # Callers get the cached array itself; keep them from mutating it
+        embedding.flags.writeable = False
+        self._emb_cache[key] = embedding
+        if len(self._emb_cache) > self._emb_cache_size:
+            self._emb_cache.popitem(last=False)
+
+    def _forward(self, waveform: torch.Tensor):
+        """Run the model on a preprocessed waveform"""
         waveform = waveform.to(self.device)
 
         # Extract embedding
-        with torch.no_grad():
+        with torch.inference_mode(), torch.autocast(
+                self._autocast_device, dtype=self._autocast_dtype,
+                enabled=self._autocast_device != 'cpu'):
             if hasattr(self.model, 'extract_embedding'):
                 embedding = self.model.extract_embedding(waveform)
             else:
                 # Direct forward pass for JIT models
                 embedding = self.model(waveform)
 
-            # Convert to numpy
-            if isinstance(embedding, torch.Tensor):
-                embedding = embedding.cpu().numpy()
+        return embedding.float()
+
+    @staticmethod
+    def _to_numpy(embedding) -> np.ndarray:
+        """Convert a model output to a normalized float32 embedding"""
+        # Convert to numpy
+        if isinstance(embedding, torch.Tensor):
+            embedding = embedding.cpu().numpy()
 
         # Normalize embedding
         embedding = embedding / np.linalg.norm(embedding)
 
-        return embedding.squeeze()
+        return np.ascontiguousarray(embedding.squeeze(), dtype=np.float32)
+
+    def _embed_pair(self, audio1: str, audio2: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Extract embeddings of two audio files concurrently"""
+        key1, key2 = self._cache_key(audio1), self._cache_key(audio2)
+        if key1 in self._emb_cache or key2 in self._emb_cache:
+            return self.extract_embedding(audio1), self.extract_embedding(audio2)
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            wav1, wav2 = pool.map(self.load_audio, [audio1, audio2])
+
+            if 'cuda' in str(self.device):
+                # Launch both forwards on separate streams, sync before cosine
+                wav1, wav2 = wav1.to(self.device), wav2.to(self.device)
+                stream1, stream2 = torch.cuda.Stream(), torch.cuda.Stream()
+                # Inputs were produced on the current stream (copy, resample)
+                stream1.wait_stream(torch.cuda.current_stream())
+                stream2.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream1):
+                    wav1.record_stream(stream1)
+                    embedding1 = self._forward(wav1)
+                with torch.cuda.stream(stream2):
+                    wav2.record_stream(stream2)
+                    embedding2 = self._forward(wav2)
+                torch.cuda.synchronize()
+            elif str(self.device) == 'cpu':
+                # The forward pass releases the GIL, so two threads overlap
+                embedding1, embedding2 = pool.map(self._forward, [wav1, wav2])
+            else:
+                # MPS serializes work on a single command queue and is not
+                # thread-safe, so run the forwards back to back
+                embedding1 = self._forward(wav1)
+                embedding2 = self._forward(wav2)
+
+        embedding1, embedding2 = self._to_numpy(embedding1), self._to_numpy(embedding2)
+        self._cache_put(key1, embedding1)
+        self._cache_put(key2, embedding2)
+        return embedding1, embedding2
+
+    def extract_embeddings(self, audio_paths: List[str], batch_size: int = 32,
+                           num_workers: int = 4) -> np.ndarray:
+        """
+        Extract speaker embeddings from several audio files in batched forward passes
 
-    def compute_similarity(self, embedding1: np.ndarray, embedding2: np.ndarray) -> float:
+        Args:
+            audio_paths: Paths to audio files
+            batch_size: Number of files per forward pass
+            num_workers: DataLoader workers decoding audio while the model runs
+
+        Returns:
+            (N, D) matrix of normalized speaker embeddings
+
+        Note:
+            Shorter files are zero padded to the longest file in their batch and
+            the model sees the padding (there is no mask), so their embeddings
+            can drift slightly from extract_embedding. Pass paths sorted by
+            duration to keep the padding small.
+        """
+        if not audio_paths:
+            return np.empty((0, self.config.get('embedding_size', 192)), dtype=np.float32)
+
+        # Worker processes only pay off once there is more than a batch to
+        # prefetch; decode small lists in-process
+        if len(audio_paths) <= batch_size:
+            num_workers = 0
+        num_workers = min(num_workers, len(audio_paths))
+
+        # Workers decode and right-pad the next batch while the model runs
+        loader = DataLoader(
+            _WavDataset(audio_paths, self.config.get('sample_rate', 16000)),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            collate_fn=_pad_collate,
+            pin_memory='cuda' in str(self.device)
+        )
+
+        results = []
+        for batch in loader:
+            # Extract embeddings
+            embeddings = self._forward(batch.to(self.device, non_blocking=True))
+            embeddings = embeddings.reshape(batch.shape[0], -1)
+            embeddings = torch.nn.functional.normalize(embeddings, dim=1)
+            results.append(embeddings.cpu().numpy())
+
+        return np.ascontiguousarray(np.concatenate(results), dtype=np.float32)
+
+    def compute_similarity(self, embedding1: np.ndarray, embedding2: np.ndarray,
+                           assume_normalized: bool = False) -> Union[float, np.ndarray]:
         """
         Compute cosine similarity between two embeddings
 
         Args:
-            embedding1: First speaker embedding
-            embedding2: Second speaker embedding
+            embedding1: First speaker embedding, or (N, D) matrix of embeddings
+            embedding2: Second speaker embedding, or (M, D) matrix of embeddings
+            assume_normalized: Skip normalization for embeddings from extract_embedding
 
         Returns:
-            Cosine similarity score
+            Cosine similarity score, or (N, M) score matrix for batched input
         """
+        embedding1 = np.ascontiguousarray(embedding1, dtype=np.float32)
+        embedding2 = np.ascontiguousarray(embedding2, dtype=np.float32)
+
         # Ensure embeddings are normalized
-        embedding1 = embedding1 / np.linalg.norm(embedding1)
-        embedding2 = embedding2 / np.linalg.norm(embedding2)
+        if not assume_normalized:
+            embedding1 = embedding1 / np.linalg.norm(embedding1, axis=-1, keepdims=True)
+            embedding2 = embedding2 / np.linalg.norm(embedding2, axis=-1, keepdims=True)
+
+        # Batched input: all pairwise scores in one GEMM
+        if embedding1.ndim == 2 or embedding2.ndim == 2:
+            return np.atleast_2d(embedding1) @ np.atleast_2d(embedding2).T
 
         # Compute cosine similarity
         similarity = np.dot(embedding1, embedding2)
@@ -171,15 +385,16 @@ class LiteSpeakerVerification:
         Returns:
             Tuple of (is_same_speaker, similarity_score)
         """
-        # Extract embeddings
-        print(f"Extracting embedding from {audio1}")
-        embedding1 = self.extract_embedding(audio1)
+        # Same file: skip both forwards (samefile raises if either is missing)
+        if os.path.samefile(audio1, audio2):
+            return 1.0 >= threshold, 1.0
 
-        print(f"Extracting embedding from {audio2}")
-        embedding2 = self.extract_embedding(audio2)
+        # Extract embeddings
+        print(f"Extracting embeddings from {audio1} and {audio2}")
+        embedding1, embedding2 = self._embed_pair(audio1, audio2)
 
         # Compute similarity
-        similarity = self.compute_similarity(embedding1, embedding2)
+        similarity = self.compute_similarity(embedding1, embedding2, assume_normalized=True)
 
         # Make decision
         is_same = similarity >= threshold
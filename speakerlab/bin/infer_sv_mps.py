@@ -9,13 +9,11 @@ Usage: python speakerlab/bin/infer_sv_mps.py --model_id iic/speech_campplus_sv_z
 import os
 import sys
 import torch
-import numpy as np
 
-# 复制原始的infer_sv.py并修改设备检测部分
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
-# 导入原始脚本的内容
-from speakerlab.bin.infer_sv import *
+# 复用原始infer_sv.py的参数解析与推理流程，只替换设备检测部分
+from speakerlab.bin import infer_sv as _isv
 
 # 修改设备检测逻辑
 def get_device():
@@ -29,20 +27,7 @@ def get_device():
         print('[INFO]: Using CPU for inference.')
         return torch.device('cpu')
 
-# 在主函数中替换设备选择
 if __name__ == '__main__':
-    # 这里需要修改原始infer_sv.py的主函数
-    # 为了简单起见，直接运行修改版本
-    
-    import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--model_id', type=str, required=True)
-    parser.add_argument('--wavs', type=str, nargs='*', default=None)
-    args = parser.parse_args()
-    
-    # 设置MPS设备
-    device = get_device()
-    print(f"Using device: {device}")
-    
-    # 运行推理
-    os.system(f"python speakerlab/bin/infer_sv.py --model_id {args.model_id}")
\ No newline at end of file
+    # 在当前进程内运行推理，避免重新启动解释器并重复加载模型
+    _isv.device = get_device()
+    _isv.main()
@@ -0,0 +1,60 @@
+"""
+In-memory store of enrolled speaker embeddings for 1-vs-N lookups.
+"""
+
+import threading
+
+import numpy as np
+
+
+class EmbeddingStore:
+    """
+    Packs L2-normalized enrolled embeddings into one contiguous float32
+    matrix, so a query against all speakers is a single GEMV.
+    """
+
+    def __init__(self, dim: int = 192):
+        self.dim = dim
+        self.E = np.empty((0, dim), dtype=np.float32)  # L2-normalized rows, C order
+        self.ids = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _normalize(self, embedding: np.ndarray) -> np.ndarray:
+        emb = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if emb.shape[0] != self.dim:
+            raise ValueError(f"Expected embedding of dim {self.dim}, got {emb.shape[0]}")
+        norm = np.linalg.norm(emb)
+        if not np.isfinite(norm) or norm == 0:
+            raise ValueError("Embedding has zero or non-finite norm")
+        return emb / norm
+
+    def add(self, speaker_id: str, embedding: np.ndarray):
+        emb = self._normalize(embedding)
+
+        with self._lock:
+            # Grow capacity geometrically instead of reallocating with vstack on every add
+            if self._size == self.E.shape[0]:
+                grown = np.empty((max(16, 2 * self._size), self.dim), dtype=np.float32)
+                grown[:self._size] = self.E[:self._size]
+                self.E = grown
+            self.E[self._size] = emb
+            self.ids.append(speaker_id)
+            self._size += 1
+
+    def query(self, embedding: np.ndarray):
+        """Return (speaker_id, score) of the best match, or (None, None) if empty"""
+        q = self._normalize(embedding)
+
+        with self._lock:
+            E = self.E[:self._size]
+        if len(E) == 0:
+            return None, None
+
+        # One GEMV gives cosine similarity against every enrolled speaker
+        scores = E @ q
+        i = int(scores.argmax())
+        return self.ids[i], float(scores[i])
+
+    def __len__(self):
+        return self._size
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from speakerlab.utils.embedding_store import EmbeddingStore
+
+
+def test_query_returns_best_match():
+    rng = np.random.default_rng(0)
+    store = EmbeddingStore(dim=8)
+    embeddings = rng.standard_normal((40, 8))
+    for i, emb in enumerate(embeddings):
+        store.add(f'spk{i}', emb)
+
+    assert len(store) == 40
+    speaker_id, score = store.query(embeddings[17] * 3.0)
+    assert speaker_id == 'spk17'
+    assert score == pytest.approx(1.0, abs=1e-5)
+
+
+def test_query_empty_store():
+    assert EmbeddingStore(dim=4).query(np.ones(4)) == (None, None)
+
+
+def test_zero_embedding_is_rejected():
+    store = EmbeddingStore(dim=4)
+    store.add('spk0', np.array([1.0, 0.0, 0.0, 0.0]))
+    with pytest.raises(ValueError):
+        store.add('silent', np.zeros(4))
+
+    speaker_id, score = store.query(np.array([0.0, 1.0, 1.0, 0.0]))
+    assert speaker_id == 'spk0'
+    assert np.isfinite(score)
+
+
+def test_dim_mismatch_is_rejected():
+    with pytest.raises(ValueError):
+        EmbeddingStore(dim=4).add('spk0', np.ones(3))